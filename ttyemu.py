@@ -9,6 +9,24 @@ import abc
 import subprocess
 import os
 import shlex
+import concurrent.futures
+import array
+import math
+import random
+import wave
+import struct
+import bisect
+import json
+import mmap
+import operator
+import itertools
+import queue
+import shutil
+import tempfile
+import errno
+import select
+import selectors
+import signal
 try:
     import pty
     import termios
@@ -25,6 +43,7 @@ except ImportError:
 
 COLUMNS = 72
 TEXT_COLOR = (0x33, 0x33, 0x33)
+SAMPLE_RATE = 22050
 
 def upper(char):
     "Converts a character to uppercase in the dumbest way possible."
@@ -59,12 +78,21 @@ class AbstractLine:
             if end == column:
                 text = text + char
                 self.extents[i] = (begin, text)
+                return
             elif end + 1 == column:
                 text = text + ' ' + char
                 self.extents[i] = (begin, text)
+                return
             # extend left? replace spaces?
         self.extents.append((column, char))
 
+    def chars(self):
+        "Yields (column, char) for every printed character"
+        for begin, text in self.extents:
+            for i, char in enumerate(text):
+                if char != ' ':
+                    yield begin+i, char
+
     def string_test(self, chars, column=0):
         """
         Insert a sequence of character, interpreting backspace, tab, and
@@ -95,6 +123,30 @@ class AbstractLine:
         for begin, text in line.extents:
             print("    ", begin, repr(text))
 
+class LazyLines(dict):
+    """
+    Maps line numbers to AbstractLines. After a restore, lines that are
+    still only in the checkpoint file are loaded the first time they are
+    looked up.
+    """
+    def __init__(self):
+        super().__init__()
+        self.source = None
+
+    def __missing__(self, line):
+        if self.source is None:
+            raise KeyError(line)
+        abstract_line = self[line] = self.source.load_line(line)
+        return abstract_line
+
+    def unloaded(self, line):
+        "Returns whether a line is in the checkpoint but not loaded yet"
+        return self.source is not None and line not in self and self.source.has_line(line)
+
+    def clear(self):
+        super().clear()
+        self.source = None
+
 SLOP = 4
 class TkinterFrontend:
     "Front-end using tkinter"
@@ -141,7 +193,12 @@ class TkinterFrontend:
             scrollregion=(-SLOP, -SLOP, COLUMNS*self.font_width+SLOP, self.font_height+SLOP),
         )
         xscrollbar.config(command=self.canvas.xview)
-        yscrollbar.config(command=self.canvas.yview)
+        yscrollbar.config(command=self.yview)
+        self.canvas.bind('<Configure>', self.view_changed)
+        self.saved_view = {}
+        self.restore_top_line = None
+        self.pending_chars = queue.Queue()
+        self.root.protocol('WM_DELETE_WINDOW', self.close)
 
     def key(self, event):
         "Handle a keyboard event"
@@ -150,8 +207,10 @@ class TkinterFrontend:
             self.terminal.backend.fast_mode ^= True
         elif event.keysym == 'Prior':
             self.canvas.yview_scroll(-1, 'pages')
+            self.view_changed()
         elif event.keysym == 'Next':
             self.canvas.yview_scroll(1, 'pages')
+            self.view_changed()
         elif event.char:
             if len(event.char) > 1 or ord(event.char) > 0xF000:
                 # weird mac tk stuff
@@ -160,8 +219,22 @@ class TkinterFrontend:
                 self.terminal.backend.write_char(event.char)
 
     def postchars(self, chars):
-        "Relay the characters from the backend to the controller"
-        self.terminal.output_chars(chars)
+        "Queue characters from the backend for the main thread"
+        # Only the main thread touches Tk, so nothing can reach the canvas
+        # once close() has destroyed it.
+        self.pending_chars.put(chars)
+
+    def poll_chars(self):
+        "Relay the queued characters to the controller"
+        chars = []
+        try:
+            while True:
+                chars.append(self.pending_chars.get_nowait())
+        except queue.Empty:
+            pass
+        if chars:
+            self.terminal.output_chars(''.join(chars))
+        self.root.after(10, self.poll_chars)
 
     # pylint: disable=invalid-name
     def draw_char(self, line, column, char):
@@ -181,10 +254,45 @@ class TkinterFrontend:
         if self.max_line < line:
             self.max_line = line
 
+    def redraw(self, lines, scroll_base):
+        "Draw all lines again"
+        self.reinit()
+        for line, abstract_line in lines.items():
+            for column, char in abstract_line.chars():
+                self.draw_char(line, column, char)
+
     def lines_screen(self):
         "Dummy"
         return self.max_line + 1
 
+    def visible_lines(self, scroll_base):
+        "Returns the range of lines in the canvas viewport"
+        top = self.canvas.canvasy(0)
+        first = max(int(top // self.font_height), 0)
+        last = int((top + self.canvas.winfo_height()) // self.font_height) + 1
+        return range(first, last)
+
+    def yview(self, *args):
+        "Scrollbar command"
+        self.canvas.yview(*args)
+        self.view_changed()
+
+    # pylint: disable=unused-argument
+    def view_changed(self, event=None):
+        "Draws checkpointed lines that have come into view"
+        if self.terminal is not None:
+            if self.restore_top_line is not None:
+                # The first <Configure> comes once the window is mapped and
+                # refresh_screen has sized the scrollregion.
+                self.scroll_to_line(self.restore_top_line)
+                self.restore_top_line = None
+            self.terminal.draw_restored_lines()
+
+    def scroll_to_line(self, line):
+        "Scrolls the canvas so line is at the top"
+        scr_height = (self.max_line + 1) * self.font_height
+        self.canvas.yview_moveto((line * self.font_height + SLOP) / (scr_height + SLOP*2))
+
     # pylint: disable=invalid-name
     # pylint: disable=unused-argument
     def refresh_screen(self, scroll_base, cursor_line, cursor_column):
@@ -207,8 +315,10 @@ class TkinterFrontend:
         #print('cursor[%s:%s] canvas[%s:%s]' % (y0, y1, cy, cy+height))
         if y0 < cy:
             self.canvas.yview_moveto(y0/scr_height)
+            self.view_changed()
         elif y1 > cy + height:
             self.canvas.yview_moveto((y1 - height + SLOP*2)/scr_height)
+            self.view_changed()
 
     def reinit(self):
         "Clear everything"
@@ -216,19 +326,42 @@ class TkinterFrontend:
         bbox = (0, 0, self.font_width, self.font_height)
         self.cursor_id = self.canvas.create_rectangle(bbox)
 
+    def view_state(self):
+        "Returns the scroll position, for checkpoints"
+        try:
+            self.saved_view = {'top_line': self.visible_lines(0).start}
+        except tkinter.TclError:
+            pass # window is gone; use what close() saved
+        return self.saved_view
+
+    def close(self):
+        "Saves the view state while the window still exists, then closes it"
+        self.view_state()
+        if self.terminal is not None:
+            self.terminal.backend.close()
+        self.root.destroy()
+
+    def restore_view(self, state):
+        "Restores the scroll position from a checkpoint, once the window is up"
+        self.restore_top_line = state.get('top_line')
+
     def mainloop(self, terminal):
         "main loop"
         self.terminal = terminal
+        self.poll_chars()
         self.root.mainloop()
 
 
 class PygameFrontend:
     "Front-end using pygame for rendering"
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, target_surface=None, lines_per_page=8):
+    def __init__(self, target_surface=None, lines_per_page=8, render_workers=None):
         pygame.init()
         self.font = pygame.font.SysFont('monospace', 24)
         self.font_width, self.font_height = self.font.size('X')
+        # upper() maps everything printable into this range, so every glyph
+        # can be rendered once here.
+        self.glyphs = {chr(c): self.font.render(chr(c), True, TEXT_COLOR) for c in range(33, 96)}
         self.width_pixels = COLUMNS * self.font_width
         if target_surface is None:
             pygame.display.set_caption('Terminal')
@@ -240,18 +373,137 @@ class PygameFrontend:
         self.target_surface = target_surface
         self.lines_per_page = lines_per_page
         self.char_event_num = pygame.USEREVENT+1
+        self.page_event_num = pygame.USEREVENT+2
+        self.redraw_event_num = pygame.USEREVENT+3
         self.terminal = None
+        # Background rendering: pages being rendered by the pool map to the
+        # characters drawn on them since their snapshot was taken, which are
+        # replayed onto the finished surface.  Results from before the last
+        # reinit/redraw are recognized by their generation and dropped.
+        # The pool is only started by the first redraw.
+        if render_workers is None:
+            render_workers = min(32, (os.cpu_count() or 1) + 4)
+        self.render_workers = render_workers
+        self.render_pool = None
+        self.pending = {}
+        self.generation = 0
+        self.worker_glyphs = queue.Queue()
+        self.worker_local = threading.local()
+        # A redraw is snapshotted and submitted a batch of pages per event,
+        # so the mainloop keeps handling input in between.
+        self.redraw_lines = None
+        self.redraw_pages = None
+        self.redraw_batch_size = 16
 
     def reinit(self, lines_per_page=None):
         "Clears and resets all terminal state"
         self.page_surfaces.clear()
+        self.pending.clear()
+        self.generation += 1
+        self.redraw_pages = None
         if lines_per_page:
             self.lines_per_page = lines_per_page
 
+    def view_state(self):
+        "Returns the page geometry, for checkpoints"
+        return {'lines_per_page': self.lines_per_page}
+
+    def restore_view(self, state):
+        "Restores the page geometry from a checkpoint"
+        self.reinit(state.get('lines_per_page'))
+
+    def redraw(self, lines, scroll_base):
+        """
+        Re-renders every page from the terminal's lines in the background.
+        Pages are left empty (None) until the workers deliver them.
+        """
+        self.reinit()
+        if not lines:
+            return
+        if self.render_pool is None:
+            self.start_render_pool()
+        last_page = max(lines) // self.lines_per_page
+        self.page_surfaces.extend([None] * (last_page + 1))
+        self.redraw_lines = lines
+        self.redraw_pages = self.pages_outward(
+            min(scroll_base // self.lines_per_page, last_page), last_page)
+        pygame.event.post(pygame.event.Event(self.redraw_event_num, generation=self.generation))
+
+    def start_render_pool(self):
+        "Starts the render workers"
+        # SDL surfaces can't be blitted from on several threads at once, so
+        # each worker takes its own copy of the glyphs on first use.
+        for _ in range(self.render_workers):
+            self.worker_glyphs.put({char: glyph.copy() for char, glyph in self.glyphs.items()})
+        self.render_pool = concurrent.futures.ThreadPoolExecutor(self.render_workers)
+
+    @staticmethod
+    def pages_outward(base_page, last_page):
+        "Yields page numbers in order of distance from base_page"
+        for distance in range(max(base_page, last_page - base_page) + 1):
+            if base_page + distance <= last_page:
+                yield base_page + distance
+            if distance and base_page - distance >= 0:
+                yield base_page - distance
+
+    def redraw_batch(self, event):
+        "Snapshots and submits the next batch of pages of a redraw"
+        if event.generation != self.generation or self.redraw_pages is None:
+            return
+        count = 0
+        for page_number in itertools.islice(self.redraw_pages, self.redraw_batch_size):
+            count += 1
+            line0 = page_number * self.lines_per_page
+            snapshot = []
+            for page_line in range(self.lines_per_page):
+                abstract_line = self.redraw_lines.get(line0 + page_line)
+                if abstract_line is not None:
+                    snapshot.append((page_line, tuple(abstract_line.extents)))
+            if snapshot:
+                self.pending[page_number] = []
+                self.render_pool.submit(self.render_page, self.generation, page_number, snapshot)
+        if count < self.redraw_batch_size:
+            self.redraw_pages = None
+        else:
+            pygame.event.post(pygame.event.Event(self.redraw_event_num, generation=self.generation))
+
+    def render_page(self, generation, page_number, snapshot):
+        "Renders a page from a snapshot of its lines (runs on a worker thread)"
+        local = self.worker_local
+        if not hasattr(local, 'glyphs'):
+            local.glyphs = self.worker_glyphs.get()
+        glyphs = local.glyphs
+        page_surface = pygame.Surface((self.width_pixels, self.lines_per_page*self.font_height))
+        page_surface.fill(background_color())
+        page_surface.blits([
+            (glyphs[char], (self.font_width*(begin+i), self.font_height*page_line))
+            for page_line, extents in snapshot
+            for begin, text in extents
+            for i, char in enumerate(text)
+            if char in glyphs], False)
+        pygame.event.post(pygame.event.Event(
+            self.page_event_num, generation=generation,
+            page_number=page_number, surface=page_surface))
+
+    def finish_page(self, event):
+        "Installs a page rendered in the background"
+        if event.generation != self.generation:
+            return
+        page_surface = event.surface
+        for page_line, column, char in self.pending.pop(event.page_number):
+            page_surface.blit(self.glyphs[char], (self.font_width*column, self.font_height*page_line))
+        self.page_surfaces[event.page_number] = page_surface
+        if self.page_visible(event.page_number, self.terminal.scroll_base):
+            self.terminal.refresh_screen()
+
     def lines_screen(self):
         "Returns the number of lines on the screen"
         return self.target_surface.get_height() // self.font_height
 
+    def visible_lines(self, scroll_base):
+        "Returns the range of lines on the screen"
+        return range(scroll_base, scroll_base + self.lines_screen())
+
     #def alloc_line(self, line_number):
     #    "Bookkeeping to make sure the cursor line is valid after a linefeed"
     #    # turned out unnecessary here
@@ -263,24 +515,36 @@ class PygameFrontend:
     def alloc_page(self, i):
         "Returns the i'th page surface"
         while len(self.page_surfaces) <= i:
+            self.page_surfaces.append(None)
+        if self.page_surfaces[i] is None:
             page_surface = pygame.Surface((self.width_pixels, self.lines_per_page*self.font_height))
             page_surface.fill(background_color())
-            self.page_surfaces.append(page_surface)
+            self.page_surfaces[i] = page_surface
         return self.page_surfaces[i]
 
-    def blit_page_to_screen(self, page_number, scroll_base):
-        "Refreshes a single page surface to the screen"
+    def page_visible(self, page_number, scroll_base):
+        "Returns whether any part of a page is on the screen"
         line0 = page_number * self.lines_per_page
         line1 = (page_number + 1) * self.lines_per_page
         if line1 < scroll_base:
-            return # page is off top of screen
+            return False # page is off top of screen
         if line0 > scroll_base + self.lines_screen():
-            return # page is off bottom of screen
+            return False # page is off bottom of screen
+        return True
+
+    def blit_page_to_screen(self, page_number, scroll_base):
+        "Refreshes a single page surface to the screen"
+        if not self.page_visible(page_number, scroll_base):
+            return
+        line0 = page_number * self.lines_per_page
         dest = (0, self.font_height*(line0 - scroll_base))
         area = pygame.Rect(0, 0, self.width_pixels, self.lines_per_page*self.font_height)
         page_surface = self.page_surfaces[page_number]
         #print("blit page", page_number, dest, area)
-        self.target_surface.blit(page_surface, dest, area)
+        if page_surface is None:
+            self.target_surface.fill(background_color(), area.move(dest))
+        else:
+            self.target_surface.blit(page_surface, dest, area)
 
     def draw_cursor(self, phys_line, column):
         "Draws the cursor"
@@ -301,10 +565,13 @@ class PygameFrontend:
 
     def draw_char(self, line, column, char):
         "Draws a character on the page backing"
-        text = self.font.render(char, True, TEXT_COLOR)
+        if char not in self.glyphs:
+            return
         page_number, page_line = divmod(line, self.lines_per_page)
         page_surface = self.alloc_page(page_number)
-        page_surface.blit(text, (self.font_width*column, self.font_height*page_line))
+        page_surface.blit(self.glyphs[char], (self.font_width*column, self.font_height*page_line))
+        if page_number in self.pending:
+            self.pending[page_number].append((page_line, column, char))
 
     def postchars(self, chars):
         "Post message with characters to render."
@@ -331,8 +598,11 @@ class PygameFrontend:
         while True:
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
+                    # main() still has to stop the backend, which may be
+                    # posting events, so pygame is left to shut down at exit.
+                    if self.render_pool is not None:
+                        self.render_pool.shutdown(wait=False, cancel_futures=True)
+                    return
                 if event.type == pygame.KEYDOWN:
                     self.handle_key(event)
                 if event.type == pygame.KEYUP:
@@ -348,6 +618,38 @@ class PygameFrontend:
                     self.terminal.refresh_screen()
                 if event.type == self.char_event_num:
                     self.terminal.output_chars(event.chars)
+                if event.type == self.page_event_num:
+                    self.finish_page(event)
+                if event.type == self.redraw_event_num:
+                    self.redraw_batch(event)
+
+    @staticmethod
+    def benchmark(num_lines=50000, worker_counts=(1, 2, 4, 8)):
+        "Times a full scrollback re-render for each worker count"
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        text = 'The quick brown fox jumps over the lazy dog.\r____________________'
+        for workers in worker_counts:
+            frontend = PygameFrontend(render_workers=workers)
+            terminal = Terminal(frontend, LoopbackBackend())
+            frontend.terminal = terminal
+            for line in range(num_lines):
+                terminal.alloc_line(line).string_test(text)
+            start = time.perf_counter()
+            terminal.redraw()
+            longest_stall = time.perf_counter() - start
+            while frontend.pending or frontend.redraw_pages is not None:
+                event = pygame.event.wait()
+                handled = time.perf_counter()
+                if event.type == frontend.page_event_num:
+                    frontend.finish_page(event)
+                elif event.type == frontend.redraw_event_num:
+                    frontend.redraw_batch(event)
+                longest_stall = max(longest_stall, time.perf_counter() - handled)
+            elapsed = time.perf_counter() - start
+            print("%d lines, %d workers: %.3f s, longest UI stall %.1f ms" % (
+                num_lines, workers, elapsed, 1000 * longest_stall))
+            frontend.render_pool.shutdown()
+            pygame.quit()
 
 # pylint: disable=unused-argument,no-self-use,missing-docstring
 class DummyFrontend:
@@ -365,12 +667,24 @@ class DummyFrontend:
     def lines_screen(self):
         return 24
 
+    def visible_lines(self, scroll_base):
+        return range(scroll_base, scroll_base + 24)
+
     def refresh_screen(self, scroll_base, cursor_phys_line, cursor_column):
         pass
 
     def reinit(self):
         pass
 
+    def redraw(self, lines, scroll_base):
+        pass
+
+    def view_state(self):
+        return {}
+
+    def restore_view(self, state):
+        pass
+
     def mainloop(self, terminal):
         self.terminal = terminal
         while True:
@@ -380,21 +694,224 @@ class DummyFrontend:
             terminal.backend.write_char(chars)
 
 
+def synthesize_sounds(rate=SAMPLE_RATE):
+    """
+    Returns mono 16-bit sample arrays for each of the teletype's noises.
+    The gains add up to less than full scale, so one of each playing at
+    once can be mixed without clipping.
+    """
+    noise = random.Random(33)
+    def decaying(seconds, tau, gain, wave_func):
+        return array.array('h', (
+            int(32767 * gain * wave_func(i / rate) * math.exp(-i / rate / tau))
+            for i in range(int(seconds * rate))))
+    def sine(freq, t):
+        return math.sin(2 * math.pi * freq * t)
+    return {
+        # Exactly 30 cycles of 60 Hz, so it loops without a click.
+        'hum': array.array('h', (
+            int(2000 * (sine(60, i / rate) + 0.5 * sine(120, i / rate)))
+            for i in range(rate // 2))),
+        'clack': decaying(0.03, 0.006, 0.35, lambda t: (
+            0.6 * noise.uniform(-1, 1) + 0.4 * sine(900, t))),
+        'thunk': decaying(0.15, 0.04, 0.3, lambda t: (
+            0.4 * noise.uniform(-1, 1) * math.exp(-t / 0.01) + 0.6 * sine(70, t))),
+        'bell': decaying(1.0, 0.3, 0.2, lambda t: 2/3 * sine(1250, t) + 1/3 * sine(3300, t)),
+    }
+
+class TeletypeSound(abc.ABC):
+    "Base class for sound output; decides which noises each character makes"
+    def output_char(self, char):
+        "Makes the noises for a character arriving at the printer"
+        self.play('clack')
+        if char == '\r':
+            self.play('thunk')
+        elif char == '\a':
+            self.play('bell')
+
+    @abc.abstractmethod
+    def play(self, name):
+        ...
+
+    def printed(self):
+        "Called once output has been refreshed on the screen"
+
+    def close(self):
+        pass
+
+class SilentSound(TeletypeSound):
+    "Sound output that does nothing"
+    def play(self, name):
+        pass
+
+class PygameSound(TeletypeSound):
+    """Plays the noises through pygame.mixer, which mixes the cached samples
+    in SDL's audio callback thread. The mixer buffer bounds the delay
+    between printing and sound (256 samples is about 12 ms)."""
+    def __init__(self, buffer_size=256):
+        pygame.mixer.quit()
+        pygame.mixer.init(SAMPLE_RATE, -16, 1, buffer_size)
+        rate, _, channels = pygame.mixer.get_init()
+        self.sounds = {}
+        self.channels = {}
+        pygame.mixer.set_num_channels(4)
+        for i, (name, samples) in enumerate(synthesize_sounds(rate).items()):
+            if channels > 1:
+                samples = array.array('h', (s for s in samples for _ in range(channels)))
+            self.sounds[name] = pygame.mixer.Sound(buffer=samples.tobytes())
+            self.channels[name] = pygame.mixer.Channel(i)
+        self.channels['hum'].play(self.sounds['hum'], loops=-1)
+
+    def play(self, name):
+        "Starts a noise on its own channel, cutting off the previous one"
+        self.channels[name].play(self.sounds[name])
+
+    def close(self):
+        "Stops the motor"
+        # The pygame front end may already have shut pygame down
+        if pygame.mixer.get_init():
+            pygame.mixer.stop()
+
+class WavSound(TeletypeSound):
+    """Headless sound output: records when each noise happens and mixes
+    them into a WAV file on close. The times output reached the screen are
+    recorded too, so sync can be checked against the file without a sound
+    card."""
+    def __init__(self, filename, rate=SAMPLE_RATE, clock=time.perf_counter):
+        self.filename = filename
+        self.rate = rate
+        self.clock = clock
+        self.sounds = synthesize_sounds(rate)
+        self.events = []
+        self.print_times = []
+        self.start = clock()
+
+    def play(self, name):
+        "Records a noise at the current time"
+        self.events.append((self.clock() - self.start, name))
+
+    def printed(self):
+        "Records the time output was shown"
+        self.print_times.append(self.clock() - self.start)
+
+    def spans(self):
+        """
+        Returns (start, end, name) sample ranges for the recorded noises.
+        Like a mixer channel, each noise is cut off by the next of its kind.
+        """
+        spans = []
+        latest = {}
+        for offset, name in self.events:
+            start = int(offset * self.rate)
+            if name in latest:
+                i = latest[name]
+                spans[i] = (spans[i][0], min(spans[i][1], start), name)
+            latest[name] = len(spans)
+            spans.append((start, start + len(self.sounds[name]), name))
+        return spans
+
+    def close(self):
+        "Mixes the recorded noises over the motor hum and writes the file a chunk at a time"
+        hum = self.sounds['hum']
+        spans = self.spans()
+        length = max([int((self.clock() - self.start) * self.rate)] + [end for _, end, _ in spans])
+        with wave.open(self.filename, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.rate)
+            active = []
+            next_span = 0
+            # Chunks are one hum loop long, so the hum lines up with each chunk.
+            for chunk_start in range(0, length, len(hum)):
+                chunk_end = min(chunk_start + len(hum), length)
+                mix = hum[:chunk_end - chunk_start]
+                while next_span < len(spans) and spans[next_span][0] < chunk_end:
+                    active.append(spans[next_span])
+                    next_span += 1
+                for start, end, name in active:
+                    begin, stop = max(start, chunk_start), min(end, chunk_end)
+                    if begin < stop:
+                        window = slice(begin - chunk_start, stop - chunk_start)
+                        mix[window] = array.array('h', map(
+                            operator.add, mix[window], self.sounds[name][begin - start:stop - start]))
+                active = [span for span in active if span[1] > chunk_end]
+                if sys.byteorder == 'big':
+                    mix.byteswap()
+                wav.writeframes(mix.tobytes())
+
+    def clack_onsets(self, threshold=300, gap=0.005):
+        """
+        Finds where noises start in the written file: the hum is subtracted
+        and an onset is the first loud sample after at least `gap` seconds
+        of quiet. Returns times in seconds.
+        """
+        with wave.open(self.filename, 'rb') as wav:
+            frames = array.array('h', wav.readframes(wav.getnframes()))
+        if sys.byteorder == 'big':
+            frames.byteswap()
+        hum = self.sounds['hum']
+        onsets = []
+        quiet = gap_samples = int(gap * self.rate)
+        for i, sample in enumerate(frames):
+            if abs(sample - hum[i % len(hum)]) < threshold:
+                quiet += 1
+            else:
+                if quiet >= gap_samples:
+                    onsets.append(i / self.rate)
+                quiet = 0
+        return onsets
+
+    def skews(self):
+        "Returns print time minus the nearest noise onset in the file, for each print"
+        onsets = self.clack_onsets()
+        return [
+            print_time - min(onsets, key=lambda onset: abs(onset - print_time))
+            for print_time in self.print_times] if onsets else []
+
+    @staticmethod
+    def sync_test(filename=None, text='THE QUICK BROWN FOX', limit=0.02):
+        "Prints at 10 cps into a WAV file (a temp file by default) and checks audio-to-print skew"
+        if filename is None:
+            filename = os.path.join(tempfile.gettempdir(), 'sync_test.wav')
+        sound = WavSound(filename)
+        terminal = Terminal(DummyFrontend(), LoopbackBackend(), sound)
+        terminal.frontend.terminal = terminal
+        for char in text:
+            terminal.output_chars(char)
+            time.sleep(0.1)
+        sound.close()
+        skews = sound.skews()
+        if not skews:
+            print("\n%d prints, %d noises: FAILED, no noises found in %s" % (
+                len(sound.print_times), len(sound.events), filename))
+            return
+        worst = max(abs(skew) for skew in skews)
+        print("\n%d prints, %d noises, worst skew %.1f ms: %s" % (
+            len(skews), len(sound.events), 1000 * worst, 'ok' if worst < limit else 'TOO HIGH'))
+
+
 class Terminal:
     "Class for keeping track of the terminal state."
 
-    def __init__(self, frontend=None, backend=None):
+    def __init__(self, frontend=None, backend=None, sound=None, checkpoint=None):
         if backend is None:
             backend = LoopbackBackend()
         if frontend is None:
             frontend = DummyFrontend(self)
+        if sound is None:
+            sound = SilentSound()
         self.line = 0
         self.column = 0
         self.scroll_base = 0
         self.max_line = 0
         self.frontend = frontend
         self.backend = backend
-        self.lines = {}
+        self.sound = sound
+        self.checkpoint = checkpoint
+        self.lines = LazyLines()
+        # Changes since the last checkpoint save (only kept with a checkpoint)
+        self.dirty_lines = set()
+        self.cleared = False
 
     def reinit(self):
         "Discard all state"
@@ -404,6 +921,13 @@ class Terminal:
         self.scroll_base = 0
         self.max_line = 0
         self.lines.clear()
+        self.dirty_lines.clear()
+        self.cleared = True
+
+    def redraw(self):
+        "Re-renders all lines (to front-end)"
+        self.frontend.redraw(self.lines, self.scroll_base)
+        self.refresh_screen()
 
     def alloc_line(self, line):
         try:
@@ -414,6 +938,7 @@ class Terminal:
     def output_char(self, char, refresh=True):
         "Simulates a teletype for a single character"
         #print("output_char", repr(char))
+        self.sound.output_char(char)
         if char == '\n':
             self.line += 1
         elif char == '\r':
@@ -427,6 +952,8 @@ class Terminal:
         elif char >= ' ':
             char = upper(char)
             self.alloc_line(self.line).place_char(self.column, char)
+            if self.checkpoint is not None:
+                self.dirty_lines.add(self.line)
             self.frontend.draw_char(self.line, self.column, char)
             self.column += 1
         self.constrain_cursor()
@@ -440,14 +967,27 @@ class Terminal:
 
     def refresh_screen(self):
         "Refreshes the screen (to front-end)"
+        self.draw_restored_lines()
         self.frontend.refresh_screen(self.scroll_base, self.line, self.column)
 
+    def draw_restored_lines(self):
+        "Loads and draws checkpointed lines that have scrolled into view"
+        if self.lines.source is None:
+            return
+        for line in self.frontend.visible_lines(self.scroll_base):
+            if self.lines.unloaded(line):
+                for column, char in self.lines[line].chars():
+                    self.frontend.draw_char(line, column, char)
+
     def output_chars(self, chars, refresh=True):
         "Calls output_char in a loop without refreshing"
         for char in chars:
             self.output_char(char, False)
         if refresh:
             self.refresh_screen()
+            self.sound.printed()
+        if self.checkpoint is not None:
+            self.checkpoint.autosave(self)
 
     def constrain_cursor(self):
         "Ensure cursor is not out of bounds"
@@ -488,6 +1028,280 @@ class Terminal:
         if self.scroll_base < 0:
             self.scroll_base = 0
 
+class Checkpoint:
+    """
+    Saves the terminal state to a file so a session can be resumed.
+
+    The file is a header followed by records, each a kind byte and a
+    payload length. Saves append records for the lines changed since the
+    last save plus the cursor and view state. Later records win. Once the
+    file has grown enough, it is compacted: every line is written once,
+    in order, followed by an index of line offsets that the header points
+    to. Compaction runs on a background thread and only reads the file, up
+    to its size when compaction started; the records appended after that
+    are copied over when the new file is moved into place. Restoring maps
+    the file and only reads the index and the records after it; lines are
+    parsed when they are first used.
+    """
+    # pylint: disable=too-many-instance-attributes
+    MAGIC = b'TTY33CKP'
+    VERSION = 2
+    HEADER = struct.Struct('<8sHQ')     # magic, version, index offset
+    RECORD = struct.Struct('<cI')       # kind, payload length
+    LINE = struct.Struct('<qI')         # line number, extent count
+    EXTENT = struct.Struct('<HH')       # begin, text length
+    STATE = struct.Struct('<qqqq')      # line, column, scroll_base, max_line
+
+    def __init__(self, filename, interval=10, compact_size=1 << 20):
+        self.filename = filename
+        self.interval = interval
+        self.compact_size = compact_size
+        self.last_save = time.monotonic()
+        self.base_size = 0
+        self.map = None
+        self.index_lines = array.array('q')
+        self.index_offsets = array.array('q')
+        self.overlay = {}
+        self.compaction = None
+        self.compacted = False
+        self.compact_from = 0
+
+    @classmethod
+    def record(cls, kind, payload):
+        "Encodes one record"
+        return cls.RECORD.pack(kind, len(payload)) + payload
+
+    @classmethod
+    def line_record(cls, line, abstract_line):
+        "Encodes a line record"
+        parts = [cls.LINE.pack(line, len(abstract_line.extents))]
+        for begin, text in abstract_line.extents:
+            parts.append(cls.EXTENT.pack(begin, len(text)))
+            parts.append(text.encode('ascii'))
+        return cls.record(b'L', b''.join(parts))
+
+    @classmethod
+    def state_records(cls, terminal):
+        "Encodes the cursor and view state records"
+        state = cls.STATE.pack(terminal.line, terminal.column, terminal.scroll_base, terminal.max_line)
+        view = json.dumps(terminal.frontend.view_state()).encode('ascii')
+        return cls.record(b'S', state) + cls.record(b'V', view)
+
+    def open(self, size=0):
+        "Maps the file (or its first size bytes) and reads the index and the records after it"
+        self.unmap()
+        with open(self.filename, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+        magic, version, index_offset = self.HEADER.unpack_from(self.map)
+        if magic != self.MAGIC:
+            raise ValueError('%s is not a checkpoint file' % self.filename)
+        if version != self.VERSION:
+            raise ValueError('unsupported checkpoint version %d' % version)
+        self.base_size = len(self.map)
+        state = view = None
+        offset = self.HEADER.size
+        if index_offset:
+            _, length = self.RECORD.unpack_from(self.map, index_offset)
+            payload = index_offset + self.RECORD.size
+            (count,) = struct.unpack_from('<Q', self.map, payload)
+            self.index_lines.frombytes(self.map[payload+8:payload+8+count*8])
+            self.index_offsets.frombytes(self.map[payload+8+count*8:payload+8+count*16])
+            if sys.byteorder == 'big':
+                self.index_lines.byteswap()
+                self.index_offsets.byteswap()
+            offset = payload + length
+        while offset + self.RECORD.size <= len(self.map):
+            kind, length = self.RECORD.unpack_from(self.map, offset)
+            payload = offset + self.RECORD.size
+            if payload + length > len(self.map):
+                break # torn write at the end
+            if kind == b'L':
+                self.overlay[self.LINE.unpack_from(self.map, payload)[0]] = offset
+            elif kind == b'S':
+                state = self.STATE.unpack_from(self.map, payload)
+            elif kind == b'V':
+                view = json.loads(self.map[payload:payload+length].decode('ascii'))
+            elif kind == b'C':
+                del self.index_lines[:], self.index_offsets[:]
+                self.overlay.clear()
+            offset = payload + length
+        return state, view
+
+    def close(self):
+        "Waits for any compaction to finish and unmaps the file"
+        if self.compaction is not None:
+            self.finish_compaction()
+        self.unmap()
+
+    def unmap(self):
+        "Unmaps the file"
+        if self.map is not None:
+            self.map.close()
+        self.map = None
+        del self.index_lines[:], self.index_offsets[:]
+        self.overlay.clear()
+
+    def line_offset(self, line):
+        "Returns the offset of a line's latest record, or None"
+        if line in self.overlay:
+            return self.overlay[line]
+        i = bisect.bisect_left(self.index_lines, line)
+        if i < len(self.index_lines) and self.index_lines[i] == line:
+            return self.index_offsets[i]
+        return None
+
+    def has_line(self, line):
+        "Returns whether the checkpoint has a line"
+        return self.line_offset(line) is not None
+
+    def raw_line(self, offset):
+        "Returns the bytes of the line record at offset"
+        _, length = self.RECORD.unpack_from(self.map, offset)
+        return self.map[offset:offset+self.RECORD.size+length]
+
+    def load_line(self, line):
+        "Parses a line from the file"
+        offset = self.line_offset(line)
+        if offset is None:
+            raise KeyError(line)
+        offset += self.RECORD.size
+        _, count = self.LINE.unpack_from(self.map, offset)
+        offset += self.LINE.size
+        abstract_line = AbstractLine()
+        for _ in range(count):
+            begin, length = self.EXTENT.unpack_from(self.map, offset)
+            offset += self.EXTENT.size
+            abstract_line.extents.append((begin, self.map[offset:offset+length].decode('ascii')))
+            offset += length
+        return abstract_line
+
+    def restore(self, terminal):
+        "Restores the terminal from the file. Returns False if there is none."
+        if not os.path.exists(self.filename):
+            return False
+        state, view = self.open()
+        terminal.reinit()
+        if view is not None:
+            terminal.frontend.restore_view(view)
+        if state is not None:
+            terminal.line, terminal.column, terminal.scroll_base, terminal.max_line = state
+        terminal.lines.source = self
+        terminal.dirty_lines.clear()
+        terminal.cleared = False
+        terminal.refresh_screen()
+        return True
+
+    def autosave(self, terminal):
+        "Saves if the interval has passed since the last save"
+        if time.monotonic() - self.last_save >= self.interval:
+            self.save(terminal)
+
+    def save(self, terminal):
+        "Appends the changes since the last save, compacting if needed"
+        self.last_save = time.monotonic()
+        if self.compaction is not None and not self.compaction.is_alive():
+            self.finish_compaction()
+        if not os.path.exists(self.filename):
+            self.write_full(terminal)
+            return
+        records = []
+        if terminal.cleared:
+            records.append(self.record(b'C', b''))
+        for line in sorted(terminal.dirty_lines):
+            records.append(self.line_record(line, terminal.lines[line]))
+        records.append(self.state_records(terminal))
+        with open(self.filename, 'ab') as file:
+            file.write(b''.join(records))
+            size = file.tell()
+        terminal.dirty_lines.clear()
+        terminal.cleared = False
+        if self.compaction is None and size > max(2 * self.base_size, self.compact_size):
+            self.compact_from = size
+            self.compacted = False
+            self.compaction = threading.Thread(target=self.compact, args=(size,), daemon=True)
+            self.compaction.start()
+
+    def compact(self, size):
+        "Writes a compacted copy of the first size bytes of the file (runs on a thread)"
+        reader = Checkpoint(self.filename)
+        try:
+            state, view = reader.open(size)
+            reader.write_compacted(self.filename + '.tmp', state, view)
+        finally:
+            reader.unmap()
+        self.compacted = True
+
+    def write_compacted(self, temp_filename, state, view):
+        "Writes the latest record of each line, an index and the state to a new file"
+        index_lines = array.array('q', sorted(set(self.index_lines).union(self.overlay)))
+        index_offsets = array.array('q')
+        with open(temp_filename, 'wb') as file:
+            file.write(self.HEADER.pack(self.MAGIC, self.VERSION, 0))
+            for line in index_lines:
+                index_offsets.append(file.tell())
+                file.write(self.raw_line(self.line_offset(line)))
+            index_offset = file.tell()
+            if sys.byteorder == 'big':
+                index_lines.byteswap()
+                index_offsets.byteswap()
+            file.write(self.record(b'I', struct.pack('<Q', len(index_lines))
+                                   + index_lines.tobytes() + index_offsets.tobytes()))
+            if state is not None:
+                file.write(self.record(b'S', self.STATE.pack(*state)))
+            if view is not None:
+                file.write(self.record(b'V', json.dumps(view).encode('ascii')))
+            file.seek(0)
+            file.write(self.HEADER.pack(self.MAGIC, self.VERSION, index_offset))
+
+    def finish_compaction(self):
+        "Moves a finished compaction into place, with the records saved since it started"
+        self.compaction.join()
+        self.compaction = None
+        temp_filename = self.filename + '.tmp'
+        if not self.compacted:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            return
+        with open(temp_filename, 'ab') as new_file, open(self.filename, 'rb') as old_file:
+            old_file.seek(self.compact_from)
+            shutil.copyfileobj(old_file, new_file)
+        self.unmap()
+        os.replace(temp_filename, self.filename)
+        self.open()
+
+    def write_full(self, terminal):
+        "Writes a new file with a single record per line and an index"
+        lines = terminal.lines
+        numbers = set(lines)
+        if lines.source is self:
+            numbers.update(self.index_lines)
+            numbers.update(self.overlay)
+        index_lines = array.array('q', sorted(numbers))
+        index_offsets = array.array('q')
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as file:
+            file.write(self.HEADER.pack(self.MAGIC, self.VERSION, 0))
+            for line in index_lines:
+                index_offsets.append(file.tell())
+                if line in lines:
+                    file.write(self.line_record(line, lines[line]))
+                else:
+                    file.write(self.raw_line(self.line_offset(line)))
+            index_offset = file.tell()
+            if sys.byteorder == 'big':
+                index_lines.byteswap()
+                index_offsets.byteswap()
+            file.write(self.record(b'I', struct.pack('<Q', len(index_lines))
+                                   + index_lines.tobytes() + index_offsets.tobytes()))
+            file.write(self.state_records(terminal))
+            file.seek(0)
+            file.write(self.HEADER.pack(self.MAGIC, self.VERSION, index_offset))
+        self.unmap()
+        os.replace(temp_filename, self.filename)
+        self.open()
+        terminal.dirty_lines.clear()
+        terminal.cleared = False
+
 class LoopbackBackend:
     "Just sends characters from the keyboard back to the screen"
     def __init__(self, postchars=lambda chars: None):
@@ -500,10 +1314,14 @@ class LoopbackBackend:
     def thread_target(self):
         pass
 
+    def close(self):
+        pass
+
 class ParamikoBackend:
     "Connects a remote host to the terminal"
     def __init__(self, host, username, keyfile, postchars=lambda chars: None):
         self.fast_mode = False
+        self.closing = False
         self.channel = None
         self.postchars = postchars
         self.host = host
@@ -538,25 +1356,46 @@ class ParamikoBackend:
                 self.postchars(byte.decode('ascii', 'replace'))
                 time.sleep(0.1)
         self.channel = None
-        self.postchars("Disconnected. Local mode.\r\n")
+        if not self.closing:
+            self.postchars("Disconnected. Local mode.\r\n")
+
+    def close(self):
+        "Closes the channel, which ends the thread"
+        self.closing = True
+        channel = self.channel
+        if channel is not None:
+            channel.close()
 
 
 class FiledescBackend(abc.ABC):
-    "Base classes for backends using os.read/write"
+    """Base classes for backends using os.read/write.
+
+    On POSIX the output fds are made non-blocking and multiplexed with a
+    selector, along with a wakeup pipe so close() can interrupt the thread
+    and (on Linux) a pidfd so the child is reaped as soon as it exits.
+    Windows can't select on pipes, so there one fd is read blocking."""
+    # pylint: disable=too-many-instance-attributes
+    selectable = os.name != 'nt'
+
     def __init__(self, lecho=False, crmod=False, postchars=lambda chars: None):
         self.fast_mode = False
         self.channel = None
         self.postchars = postchars
         self.write_fd = None
-        self.read_fd = None
+        self.read_fds = []
         self.crmod = crmod
         self.lecho = lecho
+        self.pid = None
+        self.exit_status = None
+        self.closing = False
+        self.wake_lock = threading.Lock()
+        self.wake_r = self.wake_w = None
 
     def write_char(self, char):
         if self.write_fd is not None:
             if self.crmod:
                 char = char.replace('\r', '\n')
-            os.write(self.write_fd, char.encode())
+            self.write_all(char.encode())
             if self.lecho:
                 if self.crmod:
                     char = char.replace('\n', '\r\n')
@@ -564,38 +1403,201 @@ class FiledescBackend(abc.ABC):
         else:
             self.postchars(char)
 
+    def write_all(self, data):
+        "Writes all of data, waiting whenever a non-blocking fd is full"
+        while data:
+            try:
+                data = data[os.write(self.write_fd, data):]
+            except BlockingIOError:
+                select.select([], [self.write_fd], [])
+
+    def close(self):
+        "Ends the session: wakes the thread, which kills and reaps the child"
+        with self.wake_lock:
+            self.closing = True
+            if self.wake_w is not None:
+                os.write(self.wake_w, b'x')
+
     @abc.abstractmethod
     def setup(self):
         ...
 
+    @abc.abstractmethod
+    def wait_child(self, timeout=None):
+        "Waits for the child; returns its exit code, or None on timeout"
+
+    @abc.abstractmethod
+    def stop_child(self, force):
+        "Sends the child SIGTERM, or SIGKILL if force"
+
     def teardown(self):
-        if self.read_fd is not None:
-            os.close(self.read_fd)
-        if self.write_fd is not None:
-            os.close(self.write_fd)
-        self.read_fd = self.write_fd = None
+        for fd in set(self.read_fds + [self.write_fd]):
+            if fd is not None:
+                os.close(fd)
+        self.read_fds = []
+        self.write_fd = None
 
-    def thread_target(self):
-        self.setup()
+    def reap(self):
+        "Collects the child's exit status, killing it first if the session was closed"
+        if self.exit_status is not None:
+            return
+        status = self.wait_child(0) if self.closing else self.wait_child()
+        if status is None:
+            self.stop_child(False)
+            status = self.wait_child(1)
+        if status is None:
+            self.stop_child(True)
+            status = self.wait_child()
+        self.exit_status = status
+
+    def open_pidfd(self):
+        "Returns a pidfd that becomes readable when the child exits, if supported"
+        try:
+            return os.pidfd_open(self.pid)
+        except (AttributeError, OSError):
+            return None
+
+    def pause(self, seconds):
+        "Sleeps, unless close() is called first"
+        select.select([self.wake_r], [], [], seconds)
+
+    def read_output(self, fd):
+        "Reads and posts what is available on fd. Returns False at EOF."
+        try:
+            data = os.read(fd, 1024 if self.fast_mode else 1)
+        except BlockingIOError:
+            return True
+        except OSError as ex:
+            # Linux reports EIO on a pty master once the slave side is gone
+            if ex.errno != errno.EIO:
+                raise
+            data = b''
+        if not data:
+            return False
+        if self.closing:
+            return True
+        if self.crmod:
+            data = data.replace(b'\n', b'\r\n')
+        self.postchars(data.decode('ascii', 'replace'))
+        if not self.fast_mode:
+            self.pause(0.1)
+        return True
+
+    def select_loop(self):
+        """
+        Reads from all the output fds until they are closed and the child
+        has been reaped, or close() is called. Without a pidfd the child
+        is polled for every tenth of a second.
+        """
+        self.wake_r, self.wake_w = os.pipe()
+        pidfd = self.open_pidfd()
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(self.wake_r, selectors.EVENT_READ)
+                if pidfd is not None:
+                    selector.register(pidfd, selectors.EVENT_READ)
+                for fd in self.read_fds:
+                    os.set_blocking(fd, False)
+                    selector.register(fd, selectors.EVENT_READ)
+                open_fds = len(self.read_fds)
+                timeout = None if pidfd is not None else 0.1
+                while (open_fds or self.exit_status is None) and not self.closing:
+                    for key, _ in selector.select(timeout):
+                        if key.fd == pidfd:
+                            selector.unregister(pidfd)
+                            self.exit_status = self.wait_child(0)
+                        elif self.closing:
+                            break # don't post anything more after close()
+                        elif key.fd != self.wake_r and not self.read_output(key.fd):
+                            selector.unregister(key.fd)
+                            open_fds -= 1
+                    if pidfd is None and self.exit_status is None:
+                        self.exit_status = self.wait_child(0)
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
+            with self.wake_lock:
+                os.close(self.wake_r)
+                os.close(self.wake_w)
+                self.wake_r = self.wake_w = None
+
+    def blocking_loop(self):
+        "Reads the (single) output fd with blocking reads"
+        read_fd = self.read_fds[0]
         while True:
             if self.fast_mode:
-                data = os.read(self.read_fd, 1024)
+                data = os.read(read_fd, 1024)
                 if not data:
                     break
                 if self.crmod:
                     data = data.replace(b'\n', b'\r\n')
                 self.postchars(data.decode('ascii', 'replace'))
             else:
-                byte = os.read(self.read_fd, 1)
+                byte = os.read(read_fd, 1)
                 if not byte:
                     break
                 if self.crmod:
                     byte = byte.replace(b'\n', b'\r\n')
                 self.postchars(byte.decode('ascii', 'replace'))
                 time.sleep(0.1)
-        self.teardown()
+
+    def thread_target(self):
+        self.setup()
+        try:
+            if self.selectable:
+                self.select_loop()
+            else:
+                self.blocking_loop()
+        except BaseException:
+            self.closing = True # kill the child rather than wait for it
+            raise
+        finally:
+            self.teardown()
+            self.reap()
+        if self.closing:
+            return # nobody is listening any more
+        if self.exit_status < 0:
+            self.postchars("Killed by signal %d.\r\n" % -self.exit_status)
+        else:
+            self.postchars("Exited with status %d.\r\n" % self.exit_status)
         self.postchars("Disconnected. Local mode.\r\n")
 
+    @classmethod
+    def stress_test(cls, sessions=1000):
+        "Opens and closes many sessions and checks for leaks (Linux)"
+        def open_fds():
+            return len(os.listdir('/proc/self/fd'))
+        fds_before, threads_before = open_fds(), threading.active_count()
+        times = []
+        for i in range(sessions):
+            start = time.perf_counter()
+            # Every other session is closed while its child is still running.
+            backend = cls(['sleep', '10'] if i % 2 else ['echo', 'hello'])
+            backend.fast_mode = True
+            thread = threading.Thread(target=backend.thread_target)
+            thread.start()
+            if i % 2:
+                backend.close()
+            thread.join()
+            times.append(time.perf_counter() - start)
+        zombies = 0
+        for pid in os.listdir('/proc'):
+            if pid.isdigit():
+                try:
+                    with open('/proc/%s/stat' % pid) as stat:
+                        fields = stat.read().rpartition(')')[2].split()
+                except OSError:
+                    continue # exited meanwhile
+                if fields[0] == 'Z' and int(fields[1]) == os.getpid():
+                    zombies += 1
+        print("%s: %d sessions, %d fds leaked, %d threads leaked, %d zombies" % (
+            cls.__name__, sessions, open_fds() - fds_before,
+            threading.active_count() - threads_before, zombies))
+        tenth = max(sessions // 10, 1)
+        print("mean session time: first %d %.1f ms, last %d %.1f ms" % (
+            tenth, 1000 * sum(times[:tenth]) / tenth,
+            tenth, 1000 * sum(times[-tenth:]) / tenth))
+
 class PipeBackend(FiledescBackend):
     """Backend for a subprocess running in a pipe pair.
     Not very useful, but cross-platform."""
@@ -611,19 +1613,46 @@ class PipeBackend(FiledescBackend):
             self.cmd, shell=self.shell,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
+            # stdout and stderr are read separately where they can be selected
+            stderr=subprocess.PIPE if self.selectable else subprocess.STDOUT)
+        self.pid = self.proc.pid
         self.write_fd = self.proc.stdin.fileno()
-        self.read_fd = self.proc.stdout.fileno()
+        self.read_fds = [self.proc.stdout.fileno()]
+        if self.proc.stderr is not None:
+            self.read_fds.append(self.proc.stderr.fileno())
 
     def teardown(self):
-        "Closes the file descriptors"
-        # Is there a good way to close this other than let gc take care of it?
-        self.proc = None
-        self.read_fd = self.write_fd = None
+        "Closes the pipes"
+        for pipe in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            if pipe is not None:
+                pipe.close()
+        self.read_fds = []
+        self.write_fd = None
+
+    def wait_child(self, timeout=None):
+        "Waits for the process; returns its exit code, or None on timeout"
+        try:
+            return self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            return None
+
+    def stop_child(self, force):
+        "Terminates or kills the process"
+        if force:
+            self.proc.kill()
+        else:
+            self.proc.terminate()
+
+    def close(self):
+        "Ends the session"
+        super().close()
+        if not self.selectable and self.proc is not None:
+            # Nothing to wake a blocking read except the pipe closing
+            self.proc.kill()
 
 class PtyBackend(FiledescBackend):
-    """Backend for a subprocess running in a pipe pair.
-    Not very useful, but cross-platform."""
+    """Backend for a subprocess running in a pseudo-terminal.
+    Linux/Mac only."""
     def __init__(self, cmd, shell=False, **kwargs):
         super().__init__(**kwargs)
         self.cmd = cmd
@@ -639,7 +1668,9 @@ class PtyBackend(FiledescBackend):
         "Starts the process and hooks up the file descriptors"
         pid, master = pty.fork()
         if pid:
-            self.write_fd = self.read_fd = master
+            self.pid = pid
+            self.write_fd = master
+            self.read_fds = [master]
         else:
             try:
                 attr = termios.tcgetattr(0)
@@ -658,25 +1689,52 @@ class PtyBackend(FiledescBackend):
                 os._exit(126)
             os._exit(126)
 
-    def teardown(self):
-        "Closes the file descriptor"
-        os.close(self.read_fd)
-        self.read_fd = self.write_fd = None
-
-def main(frontend, backend):
+    def wait_child(self, timeout=None):
+        "Waits for the child; returns its exit code, or None on timeout"
+        if timeout is None:
+            return os.waitstatus_to_exitcode(os.waitpid(self.pid, 0)[1])
+        deadline = time.monotonic() + timeout
+        while True:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                return os.waitstatus_to_exitcode(status)
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.01)
+
+    def stop_child(self, force):
+        "Sends the child SIGTERM or SIGKILL"
+        os.kill(self.pid, signal.SIGKILL if force else signal.SIGTERM)
+
+def main(frontend, backend, sound=None, checkpoint=None):
     "Main function"
-    my_term = Terminal(frontend, backend)
+    my_term = Terminal(frontend, backend, sound, checkpoint)
+    if checkpoint is not None:
+        checkpoint.restore(my_term)
     backend.postchars = frontend.postchars
     backend_thread = threading.Thread(target=backend.thread_target)
     backend_thread.start()
-    frontend.mainloop(my_term)
+    try:
+        frontend.mainloop(my_term)
+    finally:
+        backend.close()
+        backend_thread.join()
+        my_term.sound.close()
+        if checkpoint is not None:
+            checkpoint.save(my_term)
+            checkpoint.close()
 
 main(TkinterFrontend(), PtyBackend('sh'))
 #main(PygameFrontend(), LoopbackBackend())
+#main(PygameFrontend(), PtyBackend('sh'), PygameSound())
+#main(DummyFrontend(), PtyBackend('sh'), WavSound('tty33.wav'))
+#WavSound.sync_test()
+#main(PygameFrontend(), PtyBackend('sh'), checkpoint=Checkpoint('tty33.ckp'))
 #main(TkinterFrontend(), ConptyBackend('ubuntu'))
 #main(PygameFrontend(), PipeBackend('py -3 -i -c ""', crmod=True, lecho=True))
 #main(DummyFrontend(), LoopbackBackend())
 #main(DummyFrontend(), PtyBackend('sh'))
+#PygameFrontend.benchmark()
 #AbstractLine.unit_test('bold\rbold')
 #AbstractLine.unit_test('___________\runderlined')
 #AbstractLine.unit_test('b\bbo\bol\bld\bd')